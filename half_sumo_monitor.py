@@ -1,19 +1,24 @@
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import smtplib
 import os
 import re
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import itemgetter
+from email.message import EmailMessage
 from datetime import datetime
 from supabase import create_client, Client
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # --- CONFIGURATION ---
-HALF_SUMO_URL = "https://halfsumo.com/collections/jiu-jitsu/products.json?limit=250"
-HALF_SUMO_KEYWORD = "belt"
+HALF_SUMO_URL = "https://halfsumo.com/collections/jiu-jitsu/products.json?limit=250&fields=id,title,handle,variants"
+HALF_SUMO_KEYWORDS = ["belt"]
+# All keywords compiled into one case-insensitive matcher, so each title is scanned once
+HALF_SUMO_MATCHER = re.compile("|".join(map(re.escape, HALF_SUMO_KEYWORDS)), re.IGNORECASE)
 
 ARCTERYX_URL = "https://arcteryx.com/us/en/shop/bird-head-toque"
 ARCTERYX_PRODUCT_NAME = "Bird Head Toque"
@@ -42,19 +47,27 @@ RECEIVER_EMAIL = os.environ.get("RECEIVER_EMAIL")
 # Discord
 DISCORD_WEBHOOK_URL = os.environ.get("DISCORD_WEBHOOK_URL")
 
-def load_existing_ids():
-    """Loads all existing product IDs from Supabase to check for duplicates."""
-    try:
-        response = supabase.table("seen_items").select("id").execute()
-        return {str(record['id']) for record in response.data}
-    except Exception as e:
-        print(f"Error loading history from Supabase: {e}")
-        return set()
+# --- HTTP SESSION ---
+# One shared session for Half Sumo, Arc'teryx and Discord so connections
+# (DNS, TCP, TLS) are kept alive and reused instead of re-opened per call.
+# requests advertises "br" in Accept-Encoding (and urllib3 decodes it) whenever
+# the brotli package is installed, so the Shopify JSON comes back Brotli-compressed.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+})
+
+# Headers for bodies we serialize ourselves with orjson
+_JSON_HDRS = {"Content-Type": "application/json"}
 
 def save_all_belts(items):
-    """Upserts (Inserts or Updates) ALL belt items to the database."""
+    """
+    Upserts (Inserts or Updates) ALL belt items to the database.
+    Returns the set of IDs that were not in the database before this call.
+    """
     if not items:
-        return
+        return set()
 
     data_to_upsert = []
     for item in items:
@@ -72,77 +85,120 @@ def save_all_belts(items):
             "price": price,
         })
     
+    if not data_to_upsert:
+        return set()
+
+    try:
+        # One RPC both writes the rows and tells us which ones were inserted
+        # (see sql/upsert_and_return_new.sql)
+        response = supabase.rpc("upsert_and_return_new", {"items": data_to_upsert}).execute()
+        print(f"Successfully upserted {len(data_to_upsert)} items to Supabase.")
+        return set(map(str, map(itemgetter('id'), filter(itemgetter('is_new'), response.data))))
+    except Exception as e:
+        # sql/upsert_and_return_new.sql not applied yet: look up existing IDs, then upsert
+        print(f"upsert_and_return_new RPC unavailable, falling back to lookup + upsert: {e}")
+
     try:
-        if data_to_upsert:
-            supabase.table("seen_items").upsert(data_to_upsert).execute()
-            print(f"Successfully upserted {len(data_to_upsert)} items to Supabase.")
+        candidate_ids = [str(row['id']) for row in data_to_upsert]
+        response = supabase.table("seen_items").select("id").in_("id", candidate_ids).execute()
+        existing_ids = set(map(str, map(itemgetter('id'), response.data)))
+        supabase.table("seen_items").upsert(data_to_upsert).execute()
+        print(f"Successfully upserted {len(data_to_upsert)} items to Supabase.")
+        return set(candidate_ids) - existing_ids
     except Exception as e:
         print(f"Error saving to Supabase: {e}")
 
-def check_arcteryx_stock():
+    return set()
+
+def load_arcteryx_state():
     """
-    Checks Arc'teryx website for specific variant stock using HTML analysis.
-    Returns a list with the item IF it is newly in stock.
+    Reads the previous 'arcteryx_tracker' row for our variant:
+    its stock state plus the HTTP cache validators from the last fetch.
     """
-    print(f"Checking Arc'teryx for '{ARCTERYX_VARIANT}'...")
-    
+    state = {
+        "in_stock": False,
+        "etag": None,
+        "last_modified": None,
+        "has_cache_columns": True
+    }
+    try:
+        try:
+            res = supabase.table("arcteryx_tracker").select("in_stock, etag, last_modified").eq("variant_id", ARCTERYX_ID).execute()
+        except Exception as e:
+            # sql/arcteryx_tracker_http_cache.sql not applied yet: keep checking with a plain GET
+            print(f"Arc'teryx cache columns unavailable, checking without conditional GET: {e}")
+            state["has_cache_columns"] = False
+            res = supabase.table("arcteryx_tracker").select("in_stock").eq("variant_id", ARCTERYX_ID).execute()
+        if res.data:
+            state["in_stock"] = res.data[0]['in_stock']
+            state["etag"] = res.data[0].get('etag')
+            state["last_modified"] = res.data[0].get('last_modified')
+    except Exception as e:
+        print(f"Error fetching Arc'teryx DB state: {e}")
+
+    return state
+
+def fetch_arcteryx(state):
+    """Downloads the Arc'teryx product page, as a conditional GET when we have cache validators."""
     headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
         'Accept-Language': 'en-US,en;q=0.9'
     }
 
+    # Conditional GET: if the page hasn't changed we get an empty 304 back
+    if state["etag"]:
+        headers['If-None-Match'] = state["etag"]
+    if state["last_modified"]:
+        headers['If-Modified-Since'] = state["last_modified"]
+
+    response = SESSION.get(ARCTERYX_URL, headers=headers, timeout=15)
+    response.raise_for_status()
+    return response
+
+def check_arcteryx_stock(response, fetch_error, state):
+    """
+    Checks the fetched Arc'teryx page for specific variant stock using HTML analysis.
+    fetch_error is the exception from fetch_arcteryx(), if the download failed.
+    Returns a list with the item IF it is newly in stock.
+    """
     is_in_stock = False
 
     try:
-        response = requests.get(ARCTERYX_URL, headers=headers, timeout=15)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # 1. Check Global Stock Status (Structured Data check)
-        # We look for the JSON string, but a simpler check based on your instructions
-        # is to verify if "OutOfStock" is explicitly preventing purchase globally.
-        # However, checking the specific button is more reliable for variants.
-        
-        # 2. Check the specific Variant Button
-        # Logic: Find <fieldset>, look for button with 'Orca', check if class has 'no--stock'
-        variant_found = False
-        fieldset = soup.find('fieldset')
-        
-        if fieldset:
-            buttons = fieldset.find_all('button')
-            for btn in buttons:
-                # Check button text or aria-label for "Orca"
-                btn_text = btn.get_text() or btn.get('aria-label', '')
-                
-                if ARCTERYX_VARIANT.lower() in btn_text.lower():
-                    variant_found = True
-                    classes = btn.get('class', [])
-                    
-                    # Logic: If 'no--stock' is NOT present, it is in stock
-                    if 'no--stock' not in classes:
-                        is_in_stock = True
-                        print(f"Variant '{ARCTERYX_VARIANT}' appears to be IN STOCK.")
-                    else:
-                        is_in_stock = False
-                        print(f"Variant '{ARCTERYX_VARIANT}' is Out of Stock (has no--stock class).")
-                    break
-        
-        if not variant_found:
-            print(f"Warning: Could not find button for variant '{ARCTERYX_VARIANT}'. Layout might have changed.")
+        if fetch_error:
+            raise fetch_error
+
+        if response.status_code == 304:
+            is_in_stock = state["in_stock"]
+            etag = state["etag"]
+            last_modified = state["last_modified"]
+            print("Arc'teryx page not modified since last check, reusing previous stock state.")
+        else:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            # Imported here so runs that never parse HTML don't pay for bs4's import
+            from bs4 import BeautifulSoup
+            soup = BeautifulSoup(response.text, 'lxml')
+            
+            # Check the specific Variant Button
+            # Logic: Find the <fieldset> button for 'Orca', check if class has 'no--stock'
+            # (Checking the specific button is more reliable for variants than the
+            # page-wide "OutOfStock" structured data.)
+            # Match on aria-label via CSS first, and only fall back to scanning button text.
+            btn = soup.select_one(f'fieldset button[aria-label*="{ARCTERYX_VARIANT}" i]') or next(
+                (b for b in soup.select('fieldset button') if ARCTERYX_VARIANT.lower() in b.get_text(strip=True).lower()),
+                None
+            )
+            
+            if btn is None:
+                print(f"Warning: Could not find button for variant '{ARCTERYX_VARIANT}'. Layout might have changed.")
+            # Logic: If 'no--stock' is NOT present, it is in stock
+            elif 'no--stock' not in btn.get('class', []):
+                is_in_stock = True
+                print(f"Variant '{ARCTERYX_VARIANT}' appears to be IN STOCK.")
+            else:
+                print(f"Variant '{ARCTERYX_VARIANT}' is Out of Stock (has no--stock class).")
 
         # --- DB SYNC LOGIC ---
-        # We now check our new 'arcteryx_tracker' table to see if state changed.
-        
-        # 1. Get previous state
-        prev_in_stock = False
-        try:
-            res = supabase.table("arcteryx_tracker").select("in_stock").eq("variant_id", ARCTERYX_ID).execute()
-            if res.data:
-                prev_in_stock = res.data[0]['in_stock']
-        except Exception as e:
-            print(f"Error fetching Arc'teryx DB state: {e}")
-
-        # 2. Update DB with current state
+        # Update our 'arcteryx_tracker' table with the current state
         upsert_data = {
             "variant_id": ARCTERYX_ID,
             "product_name": ARCTERYX_PRODUCT_NAME,
@@ -150,11 +206,14 @@ def check_arcteryx_stock():
             "in_stock": is_in_stock,
             "last_checked": datetime.now().isoformat()
         }
+        if state["has_cache_columns"]:
+            upsert_data["etag"] = etag
+            upsert_data["last_modified"] = last_modified
         supabase.table("arcteryx_tracker").upsert(upsert_data).execute()
 
-        # 3. Decide to Alert
+        # Decide to Alert
         # Alert ONLY if: Currently In Stock AND (Previously Out of Stock OR First run)
-        if is_in_stock and not prev_in_stock:
+        if is_in_stock and not state["in_stock"]:
             return [{
                 'id': ARCTERYX_ID,
                 'title': f"🔥 RESTOCK: {ARCTERYX_PRODUCT_NAME} ({ARCTERYX_VARIANT})",
@@ -169,124 +228,184 @@ def check_arcteryx_stock():
     
     return []
 
-def send_email_notification(new_items):
-    """Sends an email with the list of NEW items found."""
+@contextmanager
+def smtp_session():
+    """Opens one authenticated SMTP connection that can be reused for several emails."""
+    # SMTP's own __exit__ sends QUIT, ignores an already-dropped connection and always closes the socket
+    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
+        server.starttls()
+        server.login(SENDER_EMAIL, SENDER_PASSWORD)
+        yield server
+
+def item_row(item):
+    """
+    Extracts the (title, price, link) shown in notifications for an item.
+    Handles the different URL structures per site.
+    """
+    price = item.get('variants', [{}])[0].get('price', 'N/A')
+
+    if 'link' in item:
+        link = item['link']
+    else:
+        link = f"https://halfsumo.com/products/{item.get('handle')}"
+
+    return item.get('title'), price, link
+
+def send_email_notification(rows, session=None):
+    """
+    Sends an email with the list of NEW items found, given as item_row() tuples.
+    Pass an open smtp_session() to reuse its connection; otherwise one is opened for this email.
+    Returns a status line for the log (None if email isn't configured).
+    """
     if not (SENDER_EMAIL and SENDER_PASSWORD and RECEIVER_EMAIL):
-        return
+        return None
 
-    print("Sending Email notification...")
-    subject = f"Alert: {len(new_items)} Items of Interest Found!"
+    subject = f"Alert: {len(rows)} Items of Interest Found!"
     
-    body = "The following items were found:\n\n"
-    for item in new_items:
-        title = item.get('title')
-        price = item.get('variants', [{}])[0].get('price', 'N/A')
-        
-        # Logic to handle different URL structures
-        if 'link' in item:
-            link = item['link']
-        else:
-            link = f"https://halfsumo.com/products/{item.get('handle')}"
-            
-        body += f"- {title} (${price})\n  Link: {link}\n\n"
+    parts = [f"- {title} (${price})\n  Link: {link}" for title, price, link in rows]
+
+    body = "The following items were found:\n\n" + "\n\n".join(parts)
 
-    msg = MIMEMultipart()
+    msg = EmailMessage()
     msg['From'] = SENDER_EMAIL
     msg['To'] = RECEIVER_EMAIL
     msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'plain'))
+    msg.set_content(body)
 
     try:
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.sendmail(SENDER_EMAIL, RECEIVER_EMAIL, msg.as_string())
-        server.quit()
-        print("Email notification sent.")
+        if session is None:
+            with smtp_session() as server:
+                server.send_message(msg)
+        else:
+            session.send_message(msg)
+        return "Email notification sent."
     except Exception as e:
-        print(f"Failed to send email: {e}")
+        return f"Failed to send email: {e}"
 
-def send_discord_notification(new_items):
-    """Sends a rich Discord notification."""
+def send_discord_notification(rows):
+    """
+    Sends a rich Discord notification for the given item_row() tuples.
+    Returns a status line for the log (None if Discord isn't configured).
+    """
     if not DISCORD_WEBHOOK_URL:
-        return
+        return None
 
-    print(f"Sending Discord notification...")
-    
-    fields = []
-    for item in new_items:
-        title = item.get('title')
-        price = item.get('variants', [{}])[0].get('price', 'N/A')
-        
-        if 'link' in item:
-            link = item['link']
-        else:
-            link = f"https://halfsumo.com/products/{item.get('handle')}"
-        
-        fields.append({
+    # Discord embeds hold at most 25 fields, so only format those
+    fields = [
+        {
             "name": f"{title} - ${price}",
             "value": f"[View Product]({link})",
             "inline": False
-        })
+        }
+        for title, price, link in rows[:25]
+    ]
 
     payload = {
         "content": "🚨 **Stock Alert!**",
         "embeds": [
             {
-                "title": f"Found {len(new_items)} items of interest",
+                "title": f"Found {len(rows)} items of interest",
                 "color": 5763719, # Greenish/Blue
-                "fields": fields[:25], 
+                "fields": fields,
                 "footer": { "text": "Stock Monitor Bot" }
             }
         ]
     }
 
     try:
-        requests.post(DISCORD_WEBHOOK_URL, json=payload)
-        print("Discord notification sent.")
+        SESSION.post(DISCORD_WEBHOOK_URL, data=orjson.dumps(payload), headers=_JSON_HDRS, timeout=10)
+        return "Discord notification sent."
     except Exception as e:
-        print(f"Failed to send Discord notification: {e}")
+        return f"Failed to send Discord notification: {e}"
 
-def main():
-    print(f"[{datetime.now()}] Starting Stock Check...")
-    
-    found_items = []
+def fetch_half_sumo():
+    """Downloads the Half Sumo catalog."""
+    response = SESSION.get(HALF_SUMO_URL, timeout=10)
+    response.raise_for_status()
+    return response
 
-    # --- 1. HALF SUMO CHECK ---
-    print(f"Checking Half Sumo for '{HALF_SUMO_KEYWORD}'...")
+def check_half_sumo_stock(response, fetch_error):
+    """
+    Parses the fetched Half Sumo catalog and upserts every belt to the database.
+    fetch_error is the exception from fetch_half_sumo(), if the download failed.
+    Returns the belts that were not in the database before this run.
+    """
     try:
-        response = requests.get(HALF_SUMO_URL, timeout=10)
-        response.raise_for_status()
-        products = response.json().get("products", [])
+        if fetch_error:
+            raise fetch_error
+        products = orjson.loads(response.content).get("products", [])
+
+        all_belt_items = [p for p in products if HALF_SUMO_MATCHER.search(p.get("title", ""))]
         
-        existing_ids = load_existing_ids()
+        # Save ALL belts to DB in one batch to keep prices updated
+        new_ids = save_all_belts(all_belt_items) # Upsert logic
         
-        # Check for NEW belts
-        for product in products:
-            title = product.get("title", "").lower()
-            str_id = str(product.get("id"))
-            
-            # Save ALL belts to DB to keep prices updated
-            if HALF_SUMO_KEYWORD in title:
-                save_all_belts([product]) # Upsert logic
-                
-                # Only alert if it's NEW (not in DB)
-                if str_id not in existing_ids:
-                    found_items.append(product)
+        # Only alert on belts that are NEW (not in DB before this run)
+        return [p for p in all_belt_items if str(p['id']) in new_ids]
                     
     except Exception as e:
         print(f"Half Sumo API Error: {e}")
 
+    return []
+
+def resolve(future):
+    """Returns (result, None) for a finished future, or (None, exception) if it raised."""
+    try:
+        return future.result(), None
+    except Exception as e:
+        return None, e
+
+def main():
+    print(f"[{datetime.now()}] Starting Stock Check...")
+    
+    found_items = []
+
+    # Only the two HTTP GETs (to different hosts) run on worker threads, since they
+    # don't print or touch Supabase. Parsing, DB writes and logging happen on the
+    # main thread, so the Supabase client is never shared and the log stays in order.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        print(f"Checking Half Sumo for '{', '.join(HALF_SUMO_KEYWORDS)}'...")
+        half_sumo_future = executor.submit(fetch_half_sumo)
+
+        # Arc'teryx needs its previous cache validators before it can fetch;
+        # reading them overlaps with the Half Sumo download
+        print(f"Checking Arc'teryx for '{ARCTERYX_VARIANT}'...")
+        arcteryx_state = load_arcteryx_state()
+        arcteryx_future = executor.submit(fetch_arcteryx, arcteryx_state)
+
+    # --- 1. HALF SUMO CHECK ---
+    found_items.extend(check_half_sumo_stock(*resolve(half_sumo_future)))
+
     # --- 2. ARCTERYX CHECK ---
-    # This now checks the new table and only alerts on status change
-    arcteryx_items = check_arcteryx_stock()
-    found_items.extend(arcteryx_items)
+    # Only alerts on a status change in its tracker table
+    found_items.extend(check_arcteryx_stock(*resolve(arcteryx_future), arcteryx_state))
 
     # --- 3. NOTIFICATIONS ---
     if found_items:
         print(f"Total interesting items found: {len(found_items)}")
-        send_email_notification(found_items)
-        send_discord_notification(found_items)
+        # Extract title/price/link once and share them between both channels
+        rows = [item_row(item) for item in found_items]
+        # Email and Discord are independent, so send them concurrently. The senders
+        # return their status instead of printing, so the log is written here in order.
+        print("Sending notifications...")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(send_email_notification, rows),
+                executor.submit(send_discord_notification, rows)
+            ]
+
+        # Report every sender's outcome before re-raising anything they didn't catch,
+        # so failures still fail the run
+        errors = []
+        for future in futures:
+            status, error = resolve(future)
+            if error:
+                print(f"Notification failed: {error}")
+                errors.append(error)
+            elif status:
+                print(status)
+        if errors:
+            raise errors[0]
     else:
         print("No new belts or Arc'teryx stock found.")
 
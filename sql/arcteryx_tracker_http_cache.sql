@@ -0,0 +1,5 @@
+-- Stores the HTTP cache validators from the last Arc'teryx fetch so the
+-- monitor can send a conditional GET and skip the download on 304.
+alter table arcteryx_tracker
+  add column if not exists etag text,
+  add column if not exists last_modified text;
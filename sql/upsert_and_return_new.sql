@@ -0,0 +1,16 @@
+-- Upserts a batch of Half Sumo items into seen_items and reports which rows
+-- were genuinely new, so the monitor needs a single round trip per run.
+-- (xmax = 0) is only true for rows created by this INSERT, not ones updated
+-- through ON CONFLICT.
+create or replace function upsert_and_return_new(items jsonb)
+returns table(id bigint, is_new boolean)
+language sql
+as $$
+  insert into seen_items as s (id, title, price)
+  select r.id, r.title, r.price
+  from jsonb_populate_recordset(null::seen_items, items) as r
+  on conflict (id) do update
+    set title = excluded.title,
+        price = excluded.price
+  returning s.id, (s.xmax = 0) as is_new;
+$$;